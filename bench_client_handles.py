@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Contention benchmark for the server's client roster.
+
+Compares the copy-on-write ClientHandles from server.py against the previous design where every operation serialized
+on a single lock. Many threads run the same mix of operations as the server's packet handler (look up the client,
+check that it's logged in, broadcast), while one thread keeps connecting and disconnecting clients.
+
+The churning clients claim a name but never finish logging in, so every broadcast reaches exactly the same number of
+clients in both designs. Churn is paced at a fixed target rate, like real logins would be, and the achieved rate is
+reported. An unpaced churn thread would just compete for the GIL, which says more about CPython's thread switching
+than about the roster.
+
+Two kinds of fake sockets are used. With instant sockets everything is CPU-bound, so under CPython's GIL the threads
+can't run in parallel anyway and the designs perform about the same; the copy-on-write design can even lose with many
+threads because of the extra copying. With slow sockets, sendall() blocks for a while like it does for a real client
+with a full send buffer. That's where the old design hurts: a broadcast holds the roster lock while it blocks, which
+stalls every other broadcast, login and lookup.
+"""
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from chat_protocol import Packet, UserWroteMessage
+from framed_protocol import PacketSender
+from server import ClientHandles, GENERIC_NAMES
+
+
+@dataclass
+class _MutableClientHandle:
+  logged_in: bool
+  name: Optional[str]
+  sender: PacketSender
+
+
+class LockedClientHandles:
+  """ The previous roster design, where reads and writes all take the same lock. Kept here as a baseline. """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._clients_by_id: Dict[int, _MutableClientHandle] = {}
+    self._next_client_id = 1
+
+  def add_client(self, sender: PacketSender) -> int:
+    with self._lock:
+      client_id = self._next_client_id
+      self._next_client_id += 1
+      self._clients_by_id[client_id] = _MutableClientHandle(False, None, sender)
+      return client_id
+
+  def broadcast_to_logged_in(self, packet: Packet, exclude_user: Optional[str] = None):
+    frame = bytes(packet)
+    with self._lock:
+      for sender in (handle.sender for handle in self._clients_by_id.values()
+                     if handle.logged_in and handle.name != exclude_user):
+        sender.send_frame(frame)
+
+  def try_claim_name_for_client(self, client_id: int, user_name: Optional[str]) -> Optional[str]:
+    with self._lock:
+      for name in [user_name] if user_name else GENERIC_NAMES:
+        if all(c.name != name for c in self._clients_by_id.values()):
+          self._clients_by_id[client_id].name = name
+          return name
+
+  def mark_client_as_logged_in(self, client_id: int):
+    with self._lock:
+      self._clients_by_id[client_id].logged_in = True
+
+  def is_client_logged_in(self, client_id: int):
+    with self._lock:
+      return self._clients_by_id[client_id].logged_in
+
+  def get_client_name(self, client_id: int) -> str:
+    with self._lock:
+      return self._clients_by_id[client_id].name
+
+  def remove_client(self, client_id: int):
+    with self._lock:
+      del self._clients_by_id[client_id]
+
+
+CHURN_INTERVAL = 0.001
+
+
+class _InstantSocket:
+  def sendall(self, data: bytes):
+    pass
+
+
+class _SlowSocket:
+  SEND_TIME = 0.0001
+
+  def sendall(self, data: bytes):
+    time.sleep(_SlowSocket.SEND_TIME)
+
+
+def _log_in(clients, user_name: str, socket_class) -> int:
+  client_id = clients.add_client(PacketSender(socket_class()))
+  clients.try_claim_name_for_client(client_id, user_name)
+  clients.mark_client_as_logged_in(client_id)
+  return client_id
+
+
+def run_benchmark(clients, num_threads: int, num_clients: int, duration: float, socket_class) -> Tuple[float, float]:
+  """ Returns the number of handled messages per second summed over all threads, and the churned clients per second. """
+  client_ids = [_log_in(clients, f"user-{i}", socket_class) for i in range(num_clients)]
+  # Workers hold on this until every thread is started, otherwise the spinning workers starve the threads that are
+  # still starting, and Thread.start() waits for those.
+  ready = threading.Barrier(num_threads + 2)
+  stop = threading.Event()
+  counts = [0] * num_threads
+
+  def handle_messages(thread_index: int):
+    client_id = client_ids[thread_index % num_clients]
+    count = 0
+    ready.wait()
+    while not stop.is_set():
+      if clients.is_client_logged_in(client_id):
+        user_name = clients.get_client_name(client_id)
+        clients.broadcast_to_logged_in(UserWroteMessage(user_name, "Hello"))
+      count += 1
+    counts[thread_index] = count
+
+  churned = [0]
+
+  def churn_clients():
+    i = 0
+    ready.wait()
+    while not stop.wait(CHURN_INTERVAL):
+      client_id = clients.add_client(PacketSender(socket_class()))
+      clients.try_claim_name_for_client(client_id, f"churn-{i}")
+      clients.remove_client(client_id)
+      i += 1
+    churned[0] = i
+
+  threads = [threading.Thread(target=handle_messages, args=(i,)) for i in range(num_threads)]
+  threads.append(threading.Thread(target=churn_clients))
+  for t in threads:
+    t.start()
+  ready.wait()
+  start_time = time.perf_counter()
+  time.sleep(duration)
+  stop.set()
+  elapsed = time.perf_counter() - start_time
+  for t in threads:
+    t.join()
+  return sum(counts) / elapsed, churned[0] / elapsed
+
+
+def main():
+  args = sys.argv[1:]
+  thread_counts = [int(a) for a in args] if args else [1, 4, 16, 64]
+  num_clients = 20
+  duration = 2.0
+  print(f"Every message is broadcast to {num_clients} clients.")
+  print(f"{'sockets':>8} {'threads':>8} {'locked msg/s':>13} {'churn/s':>8} {'cow msg/s':>10} {'churn/s':>8} "
+        f"{'msg speedup':>12}")
+  for socket_name, socket_class in [("instant", _InstantSocket), ("slow", _SlowSocket)]:
+    for num_threads in thread_counts:
+      locked, locked_churn = run_benchmark(LockedClientHandles(), num_threads, num_clients, duration, socket_class)
+      cow, cow_churn = run_benchmark(ClientHandles(), num_threads, num_clients, duration, socket_class)
+      print(f"{socket_name:>8} {num_threads:>8} {locked:>13.0f} {locked_churn:>8.0f} {cow:>10.0f} {cow_churn:>8.0f} "
+            f"{cow / locked:>11.2f}x")
+
+
+if __name__ == '__main__':
+  main()
@@ -4,6 +4,12 @@ from typing import Optional
 from framed_protocol import Packet, OpaquePacket, u8_to_bytes
 
 
+# Limits in bytes (utf8). A packet's payload can be at most 255 bytes, and these leave room for the header that servers
+# wrap around packets they relay to each other (see federation_protocol.RelayedPacket).
+MAX_USER_NAME_LENGTH = 32
+MAX_MESSAGE_LENGTH = 200
+
+
 def bool_to_bytes(b: bool) -> bytes:
   return bool.to_bytes(b, 1, 'big', signed=False)
 
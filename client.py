@@ -49,7 +49,16 @@ class Client:
 
   def _receive_packets(self):
     while self._connected:
-      packet = self._receiver.wait_for_packet()
+      try:
+        packet = self._receiver.wait_for_packet()
+      except ConnectionResetError as e:
+        print(f"Connection reset: {e}")
+        self.close()
+        break
+      except OSError:
+        if self._connected:
+          raise
+        break  # The socket was closed by close() while we were waiting
       if not packet:
         print("Received end-of-stream from server. Will disconnect.")
         self.close()
@@ -3,7 +3,7 @@ import sys
 from socket import socket, AF_INET, SOCK_STREAM
 from typing import Optional
 
-from chat_protocol import SubmitMessage, Packet, UserWroteMessage, UserStatusWasUpdated, UserStatus
+from chat_protocol import SubmitMessage, Packet, UserWroteMessage, UserStatusWasUpdated, UserStatus, MAX_MESSAGE_LENGTH
 from client import Client
 
 
@@ -27,6 +27,9 @@ def run_client(server_port: int, user_name: Optional[str]):
       print("WELCOME! TYPE AND CLICK RETURN TO SEND MESSAGES.")
       while True:
         message = input("")
+        if len(message.encode("utf8")) > MAX_MESSAGE_LENGTH:
+          print(f"Messages can be at most {MAX_MESSAGE_LENGTH} bytes long.")
+          continue
         chat_message = SubmitMessage(message)
         client.send_packets([chat_message])
 
@@ -0,0 +1,350 @@
+import itertools
+import random
+import threading
+import time
+from socket import socket, create_connection, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import federation_protocol
+from chat_protocol import Packet, UserWroteMessage, UserStatusWasUpdated, UserStatus, Ping
+from federation_protocol import PeerHello, RelayedPacket, ClaimName, ClaimNameResponse
+from framed_protocol import PacketSender, PacketReceiver
+
+RELAYED_PACKET_TYPES = (UserWroteMessage, UserStatusWasUpdated)
+
+
+class SequenceTracker:
+  """
+  Remembers which (origin, sequence number) pairs have been seen recently. Packets can reach a node over several
+  paths, and not necessarily in order, so a plain high-watermark isn't enough.
+  """
+  WINDOW = 10_000
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._highest_by_origin: Dict[int, int] = {}
+    self._seen_by_origin: Dict[int, Set[int]] = {}
+
+  def accept(self, origin: int, seq: int) -> bool:
+    """ Returns True the first time a given packet is seen, and False for any duplicates. """
+    with self._lock:
+      highest = self._highest_by_origin.get(origin, 0)
+      seen = self._seen_by_origin.setdefault(origin, set())
+      if seq in seen or seq <= highest - SequenceTracker.WINDOW:
+        return False
+      seen.add(seq)
+      if seq > highest:
+        self._highest_by_origin[origin] = seq
+        if len(seen) > 2 * SequenceTracker.WINDOW:
+          self._seen_by_origin[origin] = {s for s in seen if s > seq - SequenceTracker.WINDOW}
+      return True
+
+  def forget(self, origin: int):
+    with self._lock:
+      self._highest_by_origin.pop(origin, None)
+      self._seen_by_origin.pop(origin, None)
+
+
+class _PeerLink:
+  def __init__(self, node_id: str, incarnation: int, sock):
+    self.node_id = node_id
+    self.incarnation = incarnation
+    self.socket = sock
+    self.sender = PacketSender(sock)
+
+
+class _NameClaimQuery:
+  """ A name-claim that this node has passed on, and is waiting for answers to. """
+
+  def __init__(self, origin: int, query_id: int, parent: Optional[_PeerLink], children: Set[_PeerLink]):
+    self.origin = origin
+    self.query_id = query_id
+    self.parent = parent  # The link that the claim came from, or None if the claim is our own
+    self.pending = set(children)
+    self.granted = True
+    self.finished = False
+    self.done = threading.Event()
+    self.created = time.monotonic()
+
+
+class Federation:
+  """
+  Links this server to other servers (peers) so that they act as a single chat. Chat messages and user status updates
+  are relayed over the links and flooded through the peer graph, so any connected topology works.
+
+  Name-claims are flooded the same way. A node that gets a claim checks the name locally and passes the claim on to its
+  other links, and only answers once all of them have answered (or as soon as the name turns out to be taken). A claim
+  that reaches a node for the second time, e.g. around a loop, is answered right away without affecting the result. So
+  the answer that gets back to the asking node covers every node it can reach. If no answer arrives in time, the name is
+  treated as taken.
+
+  Every node publishes a heartbeat, and keeps track of which remote users logged in on which node. When a node hasn't
+  been heard from for a while, its users are announced as logged out locally. When a node is heard from for the first
+  time, the local users are announced to it again, so that nodes that join (or come back) learn who is online.
+  """
+  RECONNECT_DELAY = 1.0
+  NAME_CLAIM_TIMEOUT = 2.0
+  HEARTBEAT_INTERVAL = 1.0
+  ORIGIN_TIMEOUT = 3.5
+
+  def __init__(self, node_id: str, peer_port: int, peer_addresses: Iterable[Tuple[str, int]],
+               deliver_locally: Callable[[Packet], None], is_name_free_locally: Callable[[str], bool],
+               get_local_user_names: Callable[[], Iterable[str]]):
+    self._node_id = node_id
+    # Identifies this server process. It's the origin of the packets we publish, and tells apart different processes
+    # that claim the same node id, e.g. two nodes that were given the same --node-id. Since a restarted node gets a new
+    # incarnation, peers don't mistake its packets for ones they've already seen.
+    self._incarnation = random.getrandbits(64)
+    self._peer_port = peer_port
+    self._peer_addresses = list(peer_addresses)
+    self._deliver_locally = deliver_locally
+    self._is_name_free_locally = is_name_free_locally
+    self._get_local_user_names = get_local_user_names
+    self._tracker = SequenceTracker()
+    self._claim_tracker = SequenceTracker()
+    self._seq_counter = itertools.count(1)
+    self._query_ids = itertools.count(1)
+    self._lock = threading.Lock()
+    self._links: Tuple[_PeerLink, ...] = ()  # Copy-on-write, same as the client roster
+    self._name_claim_queries: Dict[Tuple[int, int], _NameClaimQuery] = {}
+    self._last_heard_by_origin: Dict[int, float] = {}
+    self._remote_users: Dict[str, int] = {}  # The origin that each remote user logged in on
+
+  def start(self):
+    threading.Thread(target=self._accept_new_peers, daemon=True).start()
+    threading.Thread(target=self._run_heartbeats, daemon=True).start()
+    for address in self._peer_addresses:
+      threading.Thread(target=self._maintain_link_to, args=(address,), daemon=True).start()
+
+  def publish(self, packet: Packet):
+    """
+    Relays a packet that originated on this node to all peers. User names and messages must be within the limits in
+    chat_protocol, otherwise the packet doesn't fit in a relay frame.
+    """
+    self._send_to_links(RelayedPacket(self._incarnation, next(self._seq_counter), packet))
+
+  def is_name_free_on_peers(self, user_name: str) -> bool:
+    query_id = next(self._query_ids) % 2 ** 32
+    with self._lock:
+      links = self._links
+      query = _NameClaimQuery(self._incarnation, query_id, None, set(links))
+      self._name_claim_queries[(self._incarnation, query_id)] = query
+      if not links:
+        query.finished = True
+        query.done.set()
+    try:
+      for link in links:
+        self._try_send(link, ClaimName(self._incarnation, query_id, user_name))
+      if not query.done.wait(Federation.NAME_CLAIM_TIMEOUT):
+        print(f"[{self._node_id}] Name-claim for '{user_name}' wasn't answered in time. Treating it as taken.")
+        return False
+      return query.granted
+    finally:
+      with self._lock:
+        del self._name_claim_queries[(self._incarnation, query_id)]
+
+  def _accept_new_peers(self):
+    with socket(AF_INET, SOCK_STREAM) as server_socket:
+      server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+      print(f"[{self._node_id}] Binding to peer port {self._peer_port} ...")
+      server_socket.bind(("localhost", self._peer_port))
+      server_socket.listen()
+      while True:
+        peer_socket, addr = server_socket.accept()
+        print(f"[{self._node_id}] New peer connected: {addr}")
+        threading.Thread(target=self._run_link, args=(peer_socket,), daemon=True).start()
+
+  def _maintain_link_to(self, address: Tuple[str, int]):
+    while True:
+      try:
+        peer_socket = create_connection(address)
+      except OSError:
+        time.sleep(Federation.RECONNECT_DELAY)
+        continue
+      print(f"[{self._node_id}] Connected to peer at {address}")
+      self._run_link(peer_socket)
+      time.sleep(Federation.RECONNECT_DELAY)
+
+  def _run_link(self, peer_socket):
+    receiver = PacketReceiver(peer_socket, federation_protocol.parse_packet)
+    link = None
+    try:
+      PacketSender(peer_socket).send_packet(PeerHello(self._node_id, self._incarnation))
+      hello = receiver.wait_for_packet()
+      rejection = self._check_hello(hello)
+      if rejection:
+        print(f"[{self._node_id}] Rejecting peer: {rejection}")
+        return
+      link = _PeerLink(hello.node_id, hello.incarnation, peer_socket)
+      if not self._try_add_link(link):
+        print(f"[{self._node_id}] Rejecting peer: another node with id {link.node_id} is already linked")
+        link = None
+        return
+      print(f"[{self._node_id}] Linked with peer {link.node_id}")
+      while True:
+        packet = receiver.wait_for_packet()
+        if not packet:
+          print(f"[{self._node_id}] Received end-of-stream from peer {link.node_id}.")
+          break
+        self._handle_packet_from_peer(link, packet)
+    except Exception as e:
+      # Also covers malformed packets from the peer. Either way the link is dropped, and re-established if we dialed it.
+      print(f"[{self._node_id}] Peer link failed: {e}")
+    finally:
+      if link:
+        self._remove_link(link)
+      try:
+        peer_socket.shutdown(SHUT_RDWR)
+      except OSError:
+        pass  # it may be shutdown already
+      peer_socket.close()
+
+  def _check_hello(self, hello: Optional[Packet]) -> Optional[str]:
+    """ Returns the reason for rejecting a handshake, or None if the peer is acceptable. """
+    if not isinstance(hello, PeerHello):
+      return f"unexpected handshake {hello}"
+    if hello.node_id == self._node_id:
+      return f"peer uses our own node id {hello.node_id}"
+    return None
+
+  def _handle_packet_from_peer(self, link: _PeerLink, packet: Packet):
+    if isinstance(packet, RelayedPacket):
+      if packet.origin == self._incarnation:
+        return  # Our own packet came back around a loop in the peer graph
+      if not self._tracker.accept(packet.origin, packet.origin_seq):
+        return
+      self._send_to_links(packet, exclude=link)
+      if self._track_origin(packet.origin, packet.packet):
+        self._deliver_locally(packet.packet)
+    elif isinstance(packet, ClaimName):
+      self._handle_name_claim(link, packet)
+    elif isinstance(packet, ClaimNameResponse):
+      with self._lock:
+        query = self._name_claim_queries.get((packet.origin, packet.query_id))
+        if not query or query.finished or link not in query.pending:
+          return
+        query.pending.discard(link)
+        query.granted = query.granted and packet.granted
+        if query.pending and query.granted:
+          return
+        self._mark_finished(query)
+      self._answer(query)
+
+  def _track_origin(self, origin: int, packet: Packet) -> bool:
+    """ Updates what we know about the origin of a relayed packet. Returns True if the packet should be delivered. """
+    with self._lock:
+      is_new_origin = origin not in self._last_heard_by_origin
+      self._last_heard_by_origin[origin] = time.monotonic()
+      if isinstance(packet, UserStatusWasUpdated) and packet.status == UserStatus.LOGGED_IN:
+        # Users are announced again whenever a node shows up, so the same login can arrive several times. The latest
+        # origin wins, e.g. if a user logs in again on a restarted node before the old one has been expired.
+        should_deliver = packet.user_name not in self._remote_users
+        self._remote_users[packet.user_name] = origin
+      elif isinstance(packet, UserStatusWasUpdated) and packet.status == UserStatus.LOGGED_OUT:
+        # Not if we already announced the logout ourselves when the origin went missing
+        should_deliver = self._remote_users.get(packet.user_name) == origin
+        if should_deliver:
+          del self._remote_users[packet.user_name]
+      else:
+        should_deliver = isinstance(packet, RELAYED_PACKET_TYPES)
+    if is_new_origin:
+      for user_name in self._get_local_user_names():
+        self.publish(UserStatusWasUpdated(user_name, UserStatus.LOGGED_IN))
+    return should_deliver
+
+  def _run_heartbeats(self):
+    while True:
+      self.publish(Ping())
+      for user_name in self._expire_silent_origins():
+        self._deliver_locally(UserStatusWasUpdated(user_name, UserStatus.LOGGED_OUT))
+      time.sleep(Federation.HEARTBEAT_INTERVAL)
+
+  def _expire_silent_origins(self) -> List[str]:
+    """ Forgets the origins that haven't been heard from in a while. Returns the names of their users. """
+    deadline = time.monotonic() - Federation.ORIGIN_TIMEOUT
+    with self._lock:
+      expired = {origin for origin, last_heard in self._last_heard_by_origin.items() if last_heard < deadline}
+      if not expired:
+        return []
+      print(f"[{self._node_id}] Lost contact with {len(expired)} node(s).")
+      for origin in expired:
+        del self._last_heard_by_origin[origin]
+        self._tracker.forget(origin)
+      user_names = [name for name, origin in self._remote_users.items() if origin in expired]
+      for user_name in user_names:
+        del self._remote_users[user_name]
+      return user_names
+
+  def _handle_name_claim(self, link: _PeerLink, claim: ClaimName):
+    if claim.origin == self._incarnation or not self._claim_tracker.accept(claim.origin, claim.query_id):
+      # Our own claim, or one that already reached us over another path. Whoever got it first answers for this node.
+      self._try_send(link, ClaimNameResponse(claim.origin, claim.query_id, True))
+      return
+    granted = self._is_name_free_locally(claim.user_name)
+    with self._lock:
+      children = {l for l in self._links if l is not link}
+      if granted and children:
+        self._prune_stale_queries()
+        query = _NameClaimQuery(claim.origin, claim.query_id, link, children)
+        self._name_claim_queries[(claim.origin, claim.query_id)] = query
+    if not granted or not children:
+      self._try_send(link, ClaimNameResponse(claim.origin, claim.query_id, granted))
+      return
+    for child in children:
+      self._try_send(child, claim)
+
+  def _mark_finished(self, query: _NameClaimQuery):
+    # Must be called with the lock held. The asking node removes its own query when it's done waiting.
+    query.finished = True
+    if query.parent:
+      del self._name_claim_queries[(query.origin, query.query_id)]
+
+  def _answer(self, query: _NameClaimQuery):
+    if query.parent:
+      self._try_send(query.parent, ClaimNameResponse(query.origin, query.query_id, query.granted))
+    else:
+      query.done.set()
+
+  def _prune_stale_queries(self):
+    # Must be called with the lock held. The asking node has given up on these by now.
+    deadline = time.monotonic() - Federation.NAME_CLAIM_TIMEOUT
+    for key, query in list(self._name_claim_queries.items()):
+      if query.parent and query.created < deadline:
+        del self._name_claim_queries[key]
+
+  def _send_to_links(self, packet: Packet, exclude: Optional[_PeerLink] = None):
+    for link in self._links:
+      if link is not exclude:
+        self._try_send(link, packet)
+
+  def _try_send(self, link: _PeerLink, packet: Packet):
+    try:
+      link.sender.send_packet(packet)
+    except OSError as e:
+      # The link's own receiver thread will notice and clean up
+      print(f"[{self._node_id}] Failed to send to peer {link.node_id}: {e}")
+
+  def _try_add_link(self, link: _PeerLink) -> bool:
+    with self._lock:
+      # Several links to the same node are fine (e.g. when both sides dial each other), but not to a different process
+      # that uses the same node id, since their sequence numbers would get mixed up.
+      if any(l.node_id == link.node_id and l.incarnation != link.incarnation for l in self._links):
+        return False
+      self._links = self._links + (link,)
+      return True
+
+  def _remove_link(self, link: _PeerLink):
+    answered = []
+    with self._lock:
+      self._links = tuple(l for l in self._links if l is not link)
+      for key, query in list(self._name_claim_queries.items()):
+        if query.parent is link:
+          del self._name_claim_queries[key]  # Nobody to answer anymore
+        elif link in query.pending:
+          # Counts as answered, so that the claim doesn't have to wait for the timeout
+          query.pending.discard(link)
+          if not query.pending and not query.finished:
+            self._mark_finished(query)
+            answered.append(query)
+    for query in answered:
+      self._answer(query)
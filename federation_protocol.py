@@ -0,0 +1,148 @@
+from enum import Enum
+from typing import Optional
+
+import chat_protocol
+from chat_protocol import bool_to_bytes
+from framed_protocol import Packet, OpaquePacket
+
+
+def u32_to_bytes(unsigned_32bit_int: int) -> bytes:
+  return int.to_bytes(unsigned_32bit_int, 4, 'big', signed=False)
+
+
+def u64_to_bytes(unsigned_64bit_int: int) -> bytes:
+  return int.to_bytes(unsigned_64bit_int, 8, 'big', signed=False)
+
+
+class PeerPacketType(Enum):
+  PEER_HELLO = 1
+  RELAYED_PACKET = 2
+  CLAIM_NAME = 3
+  CLAIM_NAME_RESPONSE = 4
+
+
+# These packets are only ever sent over server-to-server links. They share the framing of the client protocol but are
+# parsed by their own parser, so their type ids don't need to be distinct from the ones in chat_protocol.
+
+class PeerHello(Packet):
+  """
+  Sent by both servers when a link is established, to tell the other side who it's talking to. The incarnation is random
+  per server process, so that two processes using the same node id can be told apart.
+  """
+
+  def __init__(self, node_id: str, incarnation: int):
+    super().__init__(PeerPacketType.PEER_HELLO.value)
+    self.node_id = node_id
+    self.incarnation = incarnation
+
+  def __repr__(self):
+    return f"{super().__repr__()}({self.node_id}#{self.incarnation:x})"
+
+  def encode_payload(self) -> bytes:
+    return u64_to_bytes(self.incarnation) + self.node_id.encode("utf8")
+
+  @staticmethod
+  def decode_payload(payload: bytearray) -> Optional[Packet]:
+    incarnation = int.from_bytes(payload[0:8], 'big', signed=False)
+    node_id = payload[8:].decode("utf8")
+    return PeerHello(node_id, incarnation)
+
+
+class RelayedPacket(Packet):
+  """
+  Wraps a chat packet that should be broadcast on every node. The origin (the incarnation of the node that published
+  it) and its sequence number identify the packet across the whole federation, so that nodes can drop packets they have
+  already seen. The header has a fixed size, so that the limits in chat_protocol are enough to make every chat packet
+  fit.
+  """
+  HEADER_SIZE = 8 + 8  # origin + sequence number, followed by the wrapped packet with its own length and type
+
+  def __init__(self, origin: int, origin_seq: int, packet: Packet):
+    super().__init__(PeerPacketType.RELAYED_PACKET.value)
+    self.origin = origin
+    self.origin_seq = origin_seq
+    self.packet = packet
+
+  def __repr__(self):
+    return f"{super().__repr__()}({self.origin:x}#{self.origin_seq}: {self.packet})"
+
+  def encode_payload(self) -> bytes:
+    inner = bytes(self.packet)
+    if RelayedPacket.HEADER_SIZE + len(inner) > 255:
+      raise Exception("Payload must not be larger than 255 bytes!")
+    return u64_to_bytes(self.origin) + u64_to_bytes(self.origin_seq) + inner
+
+  @staticmethod
+  def decode_payload(payload: bytearray) -> Optional[Packet]:
+    origin = int.from_bytes(payload[0:8], 'big', signed=False)
+    origin_seq = int.from_bytes(payload[8:16], 'big', signed=False)
+    inner = Packet.extract_from(bytearray(payload[16:]))
+    return RelayedPacket(origin, origin_seq, chat_protocol.parse_packet(inner))
+
+
+class ClaimName(Packet):
+  """
+  Flooded through the federation to ask whether a user name is free on every node before a local login is accepted. The
+  origin (the incarnation of the asking node) and the query id identify the claim across the whole federation.
+  """
+
+  def __init__(self, origin: int, query_id: int, user_name: str):
+    super().__init__(PeerPacketType.CLAIM_NAME.value)
+    self.origin = origin
+    self.query_id = query_id
+    self.user_name = user_name
+
+  def __repr__(self):
+    return f"{super().__repr__()}({self.origin:x}#{self.query_id}: {self.user_name})"
+
+  def encode_payload(self) -> bytes:
+    return u64_to_bytes(self.origin) + u32_to_bytes(self.query_id) + self.user_name.encode("utf8")
+
+  @staticmethod
+  def decode_payload(payload: bytearray) -> Optional[Packet]:
+    origin = int.from_bytes(payload[0:8], 'big', signed=False)
+    query_id = int.from_bytes(payload[8:12], 'big', signed=False)
+    user_name = payload[12:].decode("utf8")
+    return ClaimName(origin, query_id, user_name)
+
+
+class ClaimNameResponse(Packet):
+  """
+  Sent back over the link that a name-claim arrived on, once the name has been checked on this node and on every node
+  behind it.
+  """
+
+  def __init__(self, origin: int, query_id: int, granted: bool):
+    super().__init__(PeerPacketType.CLAIM_NAME_RESPONSE.value)
+    self.origin = origin
+    self.query_id = query_id
+    self.granted = granted
+
+  def __repr__(self):
+    return f"{super().__repr__()}({self.origin:x}#{self.query_id}, granted={self.granted})"
+
+  def encode_payload(self) -> bytes:
+    return u64_to_bytes(self.origin) + u32_to_bytes(self.query_id) + bool_to_bytes(self.granted)
+
+  @staticmethod
+  def decode_payload(payload: bytearray) -> Optional[Packet]:
+    origin = int.from_bytes(payload[0:8], 'big', signed=False)
+    query_id = int.from_bytes(payload[8:12], 'big', signed=False)
+    granted = bool(payload[12])
+    return ClaimNameResponse(origin, query_id, granted)
+
+
+def parse_packet(opaque_packet: OpaquePacket) -> Optional[Packet]:
+  # noinspection PyBroadException
+  try:
+    packet_classes_by_type = {
+      PeerPacketType.PEER_HELLO: PeerHello,
+      PeerPacketType.RELAYED_PACKET: RelayedPacket,
+      PeerPacketType.CLAIM_NAME: ClaimName,
+      PeerPacketType.CLAIM_NAME_RESPONSE: ClaimNameResponse
+    }
+    packet_class = packet_classes_by_type[PeerPacketType(opaque_packet.packet_type)]
+    return packet_class.decode_payload(opaque_packet.payload)
+  except Exception:
+    print(f"Failed to parse peer packet: {opaque_packet}")
+    raise
@@ -13,6 +13,9 @@ class OpaquePacket:
   packet_type: int
   payload: bytearray
 
+  def __bytes__(self) -> bytes:
+    return u8_to_bytes(len(self.payload)) + u8_to_bytes(self.packet_type) + bytes(self.payload)
+
 
 class Packet(metaclass=ABCMeta):
   def __init__(self, packet_type: int):
@@ -41,20 +44,28 @@ class Packet(metaclass=ABCMeta):
 
 
 class PacketSender:
-  def __init__(self, socket):
+  def __init__(self, socket, capture: Optional[Callable[[bytes], None]] = None):
     self._socket = socket
+    self._capture = capture  # Called with every frame that is sent
     self._lock = threading.Lock()  # Sending data over a socket is not thread-safe
 
   def send_packet(self, packet: Packet):
+    self.send_frame(bytes(packet))
+
+  def send_frame(self, frame: bytes):
+    """ Sends an already encoded packet. Useful when the same packet is sent to many receivers. """
     with self._lock:
-      self._socket.sendall(bytes(packet))
+      self._socket.sendall(frame)
+      if self._capture:
+        self._capture(frame)
 
   def send_packets(self, packets: Iterable[Packet]):
-    data = b""
-    for p in packets:
-      data += bytes(p)
+    frames = [bytes(p) for p in packets]
     with self._lock:
-      self._socket.sendall(data)
+      self._socket.sendall(b"".join(frames))
+      if self._capture:
+        for frame in frames:
+          self._capture(frame)
 
 
 def debug(log_message: str):
@@ -66,15 +77,19 @@ def debug(log_message: str):
 class PacketReceiver:
   CAPACITY = 1000  # No packet is larger than this, so if the buffer fills up this much something's broken.
 
-  def __init__(self, socket, packet_parser: Callable[[OpaquePacket], Packet]):
+  def __init__(self, socket, packet_parser: Callable[[OpaquePacket], Packet],
+               capture: Optional[Callable[[bytes], None]] = None):
     self._socket = socket
     self._packet_parser = packet_parser
+    self._capture = capture  # Called with every frame that is received
     self._buffer = bytearray()
 
   def wait_for_packet(self) -> Optional[Packet]:
     while True:
       packet = Packet.extract_from(self._buffer)
       if packet:
+        if self._capture:
+          self._capture(bytes(packet))
         return self._packet_parser(packet)
 
       if len(self._buffer) > PacketReceiver.CAPACITY:
@@ -9,7 +9,8 @@ from pygame.font import Font
 from pygame.rect import Rect
 from pygame.surface import Surface
 
-from chat_protocol import UserWroteMessage, UserStatusWasUpdated, UserStatus, SubmitMessage, SubmitUserStatus
+from chat_protocol import UserWroteMessage, UserStatusWasUpdated, UserStatus, SubmitMessage, SubmitUserStatus, \
+  MAX_MESSAGE_LENGTH
 from client import Client
 from framed_protocol import Packet
 
@@ -104,7 +105,7 @@ class PygameClient:
         elif event.key == pygame.K_RETURN:
           self._client.send_packets([SubmitMessage(self._input_text)])
           self._update_input("")
-        else:
+        elif len((self._input_text + chr(event.key)).encode("utf8")) <= MAX_MESSAGE_LENGTH:
           self._update_input(self._input_text + chr(event.key))
 
     self._screen.fill((100, 50, 150))
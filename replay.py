@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Replays traffic captured with `server.py --capture FILE` against a local server, to compare builds under real load.
+
+Each recorded connection is reopened and its inbound frames are sent again, paced by the recorded timestamps (scaled by
+--speed) or as fast as possible. Before sending a frame the tool waits until every connection has received everything
+the server sent it before that frame in the recording. That keeps the replay deterministic, so the outbound frames can
+be compared with the recorded ones. Races that leave no trace in the recording (e.g. a login racing with the broadcast
+of an earlier login that nobody else was around to see) can still make --speed max differ now and then.
+
+A disconnect is recorded when the server notices it, which can be a bit after the client actually closed, and frames
+that the server failed to send to the closed client are not recorded. So at any speed, a replayed connection can receive
+logouts of other users, whose connections were closed in the recording, after everything the original client got.
+Those are reported separately as late frames. Any other extra frame is a mismatch.
+
+Latency is measured per phase, where a phase is the type of the inbound packet (LOGIN, SUBMIT_MESSAGE, ...). It is the
+time from sending a frame until the first outbound frame that followed it in the recording arrives.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from socket import create_connection, SHUT_RDWR
+from typing import Dict, List, Optional, Set, Tuple
+
+import chat_protocol
+from chat_protocol import PacketType, LoginResponse, UserStatusWasUpdated, UserStatus
+from framed_protocol import PacketReceiver, Packet
+from traffic_capture import read_recording, Record, RecordKind
+
+DRAIN_TIMEOUT = 2.0  # How long to wait for expected outbound frames before giving up on them
+SERVER_STARTUP_TIMEOUT = 5.0
+
+
+@dataclass
+class _Step:
+  record: Record
+  response_index: Optional[int] = None  # Index of the outbound frame that answered this inbound frame, if any
+  sent_at: Optional[float] = None
+
+
+@dataclass
+class Schedule:
+  steps: List[_Step]
+  expected_outbound: Dict[int, List[bytes]]  # The outbound frames that each connection is expected to receive
+  closed_user_names: Set[str]  # Users who logged in on a connection that was closed in the recording
+
+
+class _ReplayConnection:
+  def __init__(self, port: int):
+    self._socket = create_connection(("localhost", port))
+    self._condition = threading.Condition()
+    self.received_frames: List[bytes] = []
+    self.arrival_times: List[float] = []
+    threading.Thread(target=self._receive_frames, daemon=True).start()
+
+  def _receive_frames(self):
+    receiver = PacketReceiver(self._socket, lambda opaque_packet: opaque_packet, self._on_frame)
+    try:
+      while receiver.wait_for_packet():
+        pass
+    except OSError:
+      pass  # We closed the socket ourselves
+
+  def _on_frame(self, frame: bytes):
+    with self._condition:
+      self.received_frames.append(frame)
+      self.arrival_times.append(time.perf_counter())
+      self._condition.notify_all()
+
+  def wait_for_frames(self, count: int, timeout: float) -> bool:
+    with self._condition:
+      return self._condition.wait_for(lambda: len(self.received_frames) >= count, timeout)
+
+  def send(self, frame: bytes):
+    self._socket.sendall(frame)
+
+  def close(self):
+    try:
+      self._socket.shutdown(SHUT_RDWR)
+    except OSError:
+      pass  # it may be shutdown already
+    self._socket.close()
+
+
+def _parse_frame(frame: bytes) -> Packet:
+  return chat_protocol.parse_packet(Packet.extract_from(bytearray(frame)))
+
+
+def build_schedule(records: List[Record]) -> Schedule:
+  steps = []
+  outbound_by_connection: Dict[int, List[bytes]] = defaultdict(list)
+  user_name_by_connection: Dict[int, str] = {}
+  closed_connections = set()
+  unanswered: Optional[_Step] = None
+  for record in records:
+    step = _Step(record)
+    steps.append(step)
+    if record.kind == RecordKind.OUTBOUND:
+      outbound = outbound_by_connection[record.connection_id]
+      if unanswered and unanswered.record.connection_id == record.connection_id:
+        unanswered.response_index = len(outbound)
+        unanswered = None
+      outbound.append(record.frame)
+      if record.frame[1] == PacketType.LOGIN_RESPONSE.value:
+        login_response: LoginResponse = _parse_frame(record.frame)
+        if login_response.success:
+          user_name_by_connection[record.connection_id] = login_response.message
+    else:
+      # Only frames sent before anything else happens count as a response (SubmitUserStatus gets none, for example)
+      unanswered = step if record.kind == RecordKind.INBOUND else None
+      if record.kind == RecordKind.CLOSE:
+        closed_connections.add(record.connection_id)
+  closed_user_names = {name for connection_id, name in user_name_by_connection.items()
+                       if connection_id in closed_connections}
+  return Schedule(steps, outbound_by_connection, closed_user_names)
+
+
+def replay(schedule: Schedule, port: int, speed: Optional[float]) -> Tuple[Dict[int, _ReplayConnection], float]:
+  connections: Dict[int, _ReplayConnection] = {}
+  expected_counts: Dict[int, int] = defaultdict(int)
+  connections_with_pending_frames = set()
+  first_timestamp_ns = schedule.steps[0].record.timestamp_ns if schedule.steps else 0
+  start = time.perf_counter()
+  for step in schedule.steps:
+    record = step.record
+    if record.kind == RecordKind.OUTBOUND:
+      expected_counts[record.connection_id] += 1
+      connections_with_pending_frames.add(record.connection_id)
+      continue
+    if speed is not None:
+      delay = start + (record.timestamp_ns - first_timestamp_ns) / 1e9 / speed - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+    if record.kind == RecordKind.OPEN:
+      connections[record.connection_id] = _ReplayConnection(port)
+      continue
+    for connection_id in connections_with_pending_frames:
+      connections[connection_id].wait_for_frames(expected_counts[connection_id], DRAIN_TIMEOUT)
+    connections_with_pending_frames.clear()
+    connection = connections[record.connection_id]
+    if record.kind == RecordKind.INBOUND:
+      step.sent_at = time.perf_counter()
+      connection.send(record.frame)
+    elif record.kind == RecordKind.CLOSE:
+      connection.close()
+  for connection_id, connection in connections.items():
+    # Connections that were still open when the capture ended
+    connection.wait_for_frames(len(schedule.expected_outbound[connection_id]), DRAIN_TIMEOUT)
+    connection.close()
+  return connections, time.perf_counter() - start
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+  return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def _is_late_logout(frame: bytes, closed_user_names: Set[str]) -> bool:
+  if frame[1] != PacketType.USER_STATUS_WAS_UPDATED.value:
+    return False
+  packet: UserStatusWasUpdated = _parse_frame(frame)
+  return packet.status == UserStatus.LOGGED_OUT and packet.user_name in closed_user_names
+
+
+def report(schedule: Schedule, connections: Dict[int, _ReplayConnection], duration: float) -> bool:
+  """ Prints latency, throughput and verification results. Returns True if all outbound frames matched. """
+  latencies_by_phase: Dict[str, List[float]] = defaultdict(list)
+  counts_by_phase: Dict[str, int] = defaultdict(int)
+  for step in schedule.steps:
+    if step.record.kind != RecordKind.INBOUND:
+      continue
+    phase = PacketType(step.record.frame[1]).name
+    counts_by_phase[phase] += 1
+    arrival_times = connections[step.record.connection_id].arrival_times
+    if step.response_index is not None and step.response_index < len(arrival_times):
+      latencies_by_phase[phase].append((arrival_times[step.response_index] - step.sent_at) * 1000)
+
+  num_inbound = sum(counts_by_phase.values())
+  num_outbound = sum(len(c.received_frames) for c in connections.values())
+  print(f"Replayed {len(connections)} connections in {duration:.3f}s")
+  print(f"Throughput: {num_inbound / duration:.1f} inbound frames/s, {num_outbound / duration:.1f} outbound frames/s")
+  print(f"{'phase':<20} {'frames':>7} {'frames/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+  for phase, count in sorted(counts_by_phase.items()):
+    latencies = sorted(latencies_by_phase[phase])
+    if latencies:
+      stats = f"{_percentile(latencies, 0.5):>8.2f} {_percentile(latencies, 0.99):>8.2f} {latencies[-1]:>8.2f}"
+    else:
+      stats = f"{'-':>8} {'-':>8} {'-':>8}"
+    print(f"{phase:<20} {count:>7} {count / duration:>9.1f} {stats}")
+
+  num_expected = sum(len(frames) for frames in schedule.expected_outbound.values())
+  num_matched = 0
+  mismatches = []
+  late = []
+  for connection_id, expected in sorted(schedule.expected_outbound.items()):
+    received = connections[connection_id].received_frames if connection_id in connections else []
+    matched = sum(1 for e, r in zip(expected, received) if e == r)
+    num_matched += matched
+    extra = received[len(expected):]
+    if matched == len(expected) and extra \
+        and all(_is_late_logout(frame, schedule.closed_user_names) for frame in extra):
+      # Everything the original client got arrived, and then the logouts it missed. See the module docstring.
+      late.append(f"connection {connection_id}: {len(extra)} logouts after the last recorded frame")
+    elif matched != len(expected) or len(received) != len(expected):
+      mismatches.append(f"connection {connection_id}: {matched}/{len(expected)} frames matched, "
+                        f"{len(received)} received")
+  print(f"Verification: {num_matched}/{num_expected} outbound frames matched")
+  for entry in late:
+    print(f"  LATE {entry}")
+  for mismatch in mismatches:
+    print(f"  MISMATCH {mismatch}")
+  return not mismatches
+
+
+def start_local_server(port: int) -> subprocess.Popen:
+  server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+  process = subprocess.Popen([sys.executable, server_script, "--port", str(port)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  deadline = time.monotonic() + SERVER_STARTUP_TIMEOUT
+  while True:
+    try:
+      create_connection(("localhost", port)).close()
+      return process
+    except OSError:
+      if time.monotonic() > deadline:
+        process.kill()
+        raise Exception(f"Server didn't start listening on port {port}")
+      time.sleep(0.05)
+
+
+def parse_speed(speed: str) -> Optional[float]:
+  """ Parses "max", or a multiplier such as "10" or "10x". """
+  if speed == "max":
+    return None
+  try:
+    multiplier = float(speed[:-1] if speed.endswith("x") else speed)
+  except ValueError:
+    raise argparse.ArgumentTypeError(f"invalid speed: {speed}")
+  if multiplier <= 0:
+    raise argparse.ArgumentTypeError(f"speed must be larger than 0: {speed}")
+  return multiplier
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Replay captured traffic against a local server.")
+  parser.add_argument("capture", help="file recorded with server.py --capture")
+  parser.add_argument("--port", type=int, default=5199, help="port of the server to replay against")
+  parser.add_argument("--speed", type=parse_speed, default=1.0, metavar="Nx|max",
+                      help="replay at N times the recorded speed (e.g. 1x, 10x), or as fast as possible (default: 1x)")
+  parser.add_argument("--no-spawn", action="store_true",
+                      help="replay against an already running server instead of starting one")
+  args = parser.parse_args()
+
+  schedule = build_schedule(list(read_recording(args.capture)))
+  server_process = None if args.no_spawn else start_local_server(args.port)
+  try:
+    connections, duration = replay(schedule, args.port, args.speed)
+    all_matched = report(schedule, connections, duration)
+  finally:
+    if server_process:
+      server_process.kill()
+  sys.exit(0 if all_matched else 1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,91 +1,131 @@
 #!/usr/bin/env python3
+import argparse
+import random
 import threading
-from dataclasses import dataclass
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR
-from typing import Dict, Optional
+from dataclasses import dataclass, replace
+from socket import socket, gethostname, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR
+from typing import Dict, List, Optional, Mapping, Iterable, Tuple
 
 import chat_protocol
 from chat_protocol import SubmitMessage, UserWroteMessage, Packet, UserStatusWasUpdated, \
-  UserStatus, Login, LoginResponse, SubmitUserStatus
+  UserStatus, Login, LoginResponse, SubmitUserStatus, MAX_USER_NAME_LENGTH, MAX_MESSAGE_LENGTH
+from federation import Federation
 from framed_protocol import PacketSender, PacketReceiver
+from traffic_capture import TrafficRecorder, ConnectionCapture
 
 GENERIC_NAMES = ["Alice", "Bob", "Charlie"]
 
 
-@dataclass
+@dataclass(frozen=True)
 class ClientHandle:
   logged_in: bool
   name: Optional[str]
   sender: PacketSender
+  capture: Optional[ConnectionCapture] = None
 
 
 class ClientHandles:
+  """
+  The roster is an immutable snapshot (a dict that is never mutated after being published) that gets swapped out
+  atomically whenever membership changes. Reads and broadcasts just grab the current snapshot and never take a lock;
+  only writers (login, logout etc) serialize on the lock.
+  """
+
   def __init__(self):
-    self._lock = threading.Lock()
-    self._clients_by_id: Dict[int, ClientHandle] = {}
+    self._write_lock = threading.Lock()
+    self._clients_by_id: Mapping[int, ClientHandle] = {}
     self._next_client_id = 1
 
-  def add_client(self, sender: PacketSender) -> int:
-    with self._lock:
+  def add_client(self, sender: PacketSender, capture: Optional[ConnectionCapture] = None) -> int:
+    with self._write_lock:
       client_id = self._next_client_id
       self._next_client_id += 1
-      self._clients_by_id[client_id] = ClientHandle(False, None, sender)
+      self._publish({**self._clients_by_id, client_id: ClientHandle(False, None, sender, capture)})
       return client_id
 
   def broadcast_to_logged_in(self, packet: Packet, exclude_user: Optional[str] = None):
-    with self._lock:
-      for sender in (handle.sender for handle in self._clients_by_id.values()
-                     if handle.logged_in and handle.name != exclude_user):
-        sender.send_packet(packet)
+    frame = bytes(packet)
+    for handle in self._clients_by_id.values():
+      if handle.logged_in and handle.name != exclude_user:
+        try:
+          handle.sender.send_frame(frame)
+        except OSError as e:
+          # The snapshot may still contain clients that just disconnected. Their own threads will clean them up.
+          print(f"Failed to send {packet} to {handle.name}: {e}")
 
   def send_to_client(self, client_id, packet: Packet):
-    with self._lock:
-      self._clients_by_id[client_id].sender.send_packet(packet)
-
-  def try_claim_name_for_client(self, client_id: int, user_name: Optional[str]) -> Optional[str]:
-    with self._lock:
-      if user_name:
-        if self._is_name_free(user_name):
-          self._clients_by_id[client_id].name = user_name
-          return user_name
-      else:
-        # No user name requested. Try to assign a generic one.
-        for generic_name in GENERIC_NAMES:
-          if self._is_name_free(generic_name):
-            self._clients_by_id[client_id].name = generic_name
-            return generic_name
+    self._clients_by_id[client_id].sender.send_packet(packet)
+
+  def try_claim_name_for_client(self, client_id: int, user_name: str) -> bool:
+    with self._write_lock:
+      if self.is_name_free(user_name):
+        self._update_client(client_id, name=user_name)
+        return True
+      return False
+
+  def release_name_for_client(self, client_id: int):
+    with self._write_lock:
+      self._update_client(client_id, name=None)
 
-  def _is_name_free(self, user_name: str):
+  def get_logged_in_names(self) -> List[str]:
+    return [c.name for c in self._clients_by_id.values() if c.logged_in]
+
+  def is_name_free(self, user_name: str):
     for c in self._clients_by_id.values():
       if c.name == user_name:
         return False
     return True
 
   def mark_client_as_logged_in(self, client_id: int):
-    with self._lock:
-      self._clients_by_id[client_id].logged_in = True
+    with self._write_lock:
+      self._update_client(client_id, logged_in=True)
+
+  def get_client(self, client_id: int) -> ClientHandle:
+    return self._clients_by_id[client_id]
 
   def is_client_logged_in(self, client_id: int):
-    with self._lock:
-      return self._clients_by_id[client_id].logged_in
+    return self._clients_by_id[client_id].logged_in
 
   def get_client_name(self, client_id: int) -> str:
-    with self._lock:
-      return self._clients_by_id[client_id].name
+    return self._clients_by_id[client_id].name
 
   def remove_client(self, client_id: int):
-    with self._lock:
-      del self._clients_by_id[client_id]
+    with self._write_lock:
+      clients_by_id = dict(self._clients_by_id)
+      del clients_by_id[client_id]
+      self._publish(clients_by_id)
+
+  def _update_client(self, client_id: int, **changes):
+    # Must be called with the write lock held
+    updated_handle = replace(self._clients_by_id[client_id], **changes)
+    self._publish({**self._clients_by_id, client_id: updated_handle})
+
+  def _publish(self, clients_by_id: Dict[int, ClientHandle]):
+    # Rebinding the attribute is atomic, so readers see either the old or the new snapshot, never a partial one.
+    self._clients_by_id = clients_by_id
 
 
 class Server:
 
-  def __init__(self, port: int):
+  def __init__(self, port: int, node_id: Optional[str] = None, peer_port: Optional[int] = None,
+               peer_addresses: Iterable[Tuple[str, int]] = (), capture_path: Optional[str] = None):
     self._port = port
     self._clients = ClientHandles()
+    self._recorder = TrafficRecorder(capture_path) if capture_path else None
+    self._federation: Optional[Federation] = None
+    if peer_port is not None:
+      self._federation = Federation(node_id or default_node_id(port), peer_port, peer_addresses,
+                                    self._clients.broadcast_to_logged_in, self._clients.is_name_free,
+                                    self._clients.get_logged_in_names)
 
   def run(self):
-    self._accept_new_clients(self._port)
+    if self._federation:
+      self._federation.start()
+    try:
+      self._accept_new_clients(self._port)
+    finally:
+      if self._recorder:
+        self._recorder.close()
 
   def _accept_new_clients(self, port):
     with socket(AF_INET, SOCK_STREAM) as server_socket:
@@ -97,14 +137,17 @@ class Server:
         print("Waiting for client to connect...")
         client_socket, addr = server_socket.accept()
         print(f"New client connected: {addr}")
-        client_id = self._clients.add_client(PacketSender(client_socket))
+        capture = self._recorder.new_connection() if self._recorder else None
+        sender = PacketSender(client_socket, capture.outbound if capture else None)
+        client_id = self._clients.add_client(sender, capture)
         print(f"Client was assigned id {client_id}")
 
         client_thread = threading.Thread(target=self._communicate_with_client, args=(client_id, client_socket,))
         client_thread.start()
 
   def _communicate_with_client(self, client_id: int, client_socket):
-    receiver = PacketReceiver(client_socket, chat_protocol.parse_packet)
+    capture = self._clients.get_client(client_id).capture
+    receiver = PacketReceiver(client_socket, chat_protocol.parse_packet, capture.inbound if capture else None)
     try:
       should_continue = True
       while should_continue:
@@ -122,25 +165,48 @@ class Server:
 
   def _handle_packet_from_client(self, client_id: int, client_socket, packet: Packet):
     if isinstance(packet, SubmitMessage):
-      if not self._clients.is_client_logged_in(client_id):
+      client = self._clients.get_client(client_id)
+      if not client.logged_in:
         print(f"[{client_id}] Client tries to send message before logging in! Will disconnect client.")
         self._disconnect_client(client_id, client_socket)
         return True
+      if len(packet.message.encode("utf8")) > MAX_MESSAGE_LENGTH:
+        # Rejected for everyone, so that all nodes in a federation see the same messages
+        print(f"[{client_id}] Dropping message longer than {MAX_MESSAGE_LENGTH} bytes.")
+        return
       print(f"[{client_id}] Broadcasting response to clients...")
-      user_name = self._clients.get_client_name(client_id)
-      self._clients.broadcast_to_logged_in(UserWroteMessage(user_name, packet.message))
+      self._broadcast(UserWroteMessage(client.name, packet.message))
       print(f"[{client_id}] Broadcast complete.")
     elif isinstance(packet, Login):
-      claimed_name = self._clients.try_claim_name_for_client(client_id, packet.user_name)
+      if len(packet.user_name.encode("utf8")) > MAX_USER_NAME_LENGTH:
+        self._clients.send_to_client(client_id, LoginResponse(False, "Name too long."))
+        return
+      claimed_name = self._claim_name(client_id, packet.user_name)
       if claimed_name:
         self._clients.send_to_client(client_id, LoginResponse(True, claimed_name))
-        self._clients.broadcast_to_logged_in(UserStatusWasUpdated(claimed_name, UserStatus.LOGGED_IN))
+        # Mark the client before announcing it, so that it doesn't miss messages from users who already see it
         self._clients.mark_client_as_logged_in(client_id)
+        self._broadcast(UserStatusWasUpdated(claimed_name, UserStatus.LOGGED_IN), exclude_user=claimed_name)
       else:
         self._clients.send_to_client(client_id, LoginResponse(False, "Name taken."))
     elif isinstance(packet, SubmitUserStatus):
       user_name = self._clients.get_client_name(client_id)
-      self._clients.broadcast_to_logged_in(UserStatusWasUpdated(user_name, packet.status), exclude_user=user_name)
+      self._broadcast(UserStatusWasUpdated(user_name, packet.status), exclude_user=user_name)
+
+  def _claim_name(self, client_id: int, user_name: Optional[str]) -> Optional[str]:
+    # If no user name was requested, try to assign a generic one.
+    candidates = [user_name] if user_name else GENERIC_NAMES
+    for candidate in candidates:
+      if self._clients.try_claim_name_for_client(client_id, candidate):
+        # The name stays reserved locally while peers are asked, so that concurrent claims from peers are denied.
+        if not self._federation or self._federation.is_name_free_on_peers(candidate):
+          return candidate
+        self._clients.release_name_for_client(client_id)
+
+  def _broadcast(self, packet: Packet, exclude_user: Optional[str] = None):
+    self._clients.broadcast_to_logged_in(packet, exclude_user)
+    if self._federation:
+      self._federation.publish(packet)
 
   def _disconnect_client(self, client_id: int, client_socket):
     try:
@@ -148,14 +214,39 @@ class Server:
     except OSError:
       pass  # it may be shutdown already
     client_socket.close()
-    was_logged_in = self._clients.is_client_logged_in(client_id)
-    user_name = self._clients.get_client_name(client_id)
+    client = self._clients.get_client(client_id)
+    if client.capture:
+      # Recorded before the logout is broadcast, so that a replay sees the disconnect before its consequences
+      client.capture.close()
     self._clients.remove_client(client_id)
     print(f"[{client_id}] Disconnected client {client_id}")
-    if was_logged_in:
-      self._clients.broadcast_to_logged_in(UserStatusWasUpdated(user_name, UserStatus.LOGGED_OUT))
+    if client.logged_in:
+      self._broadcast(UserStatusWasUpdated(client.name, UserStatus.LOGGED_OUT))
 
 
-if __name__ == '__main__':
-  server = Server(5100)
+def default_node_id(port: int) -> str:
+  return f"{gethostname()}:{port}-{random.getrandbits(32):08x}"
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+  host, _, port = address.rpartition(":")
+  return host or "localhost", int(port)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run a chat server, optionally linked with other servers.")
+  parser.add_argument("--port", type=int, default=5100, help="port that clients connect to")
+  parser.add_argument("--node-id", help="name of this node in the federation (default: <host>:<port>-<random>)")
+  parser.add_argument("--peer-port", type=int, help="port that other servers link to (enables federation)")
+  parser.add_argument("--peer", action="append", default=[], type=parse_address, metavar="HOST:PORT",
+                      help="peer port of another server to link to (can be repeated)")
+  parser.add_argument("--capture", metavar="FILE", help="record all client traffic to FILE (see replay.py)")
+  args = parser.parse_args()
+  if args.peer and args.peer_port is None:
+    parser.error("--peer requires --peer-port")
+  server = Server(args.port, args.node_id, args.peer_port, args.peer, args.capture)
   server.run()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,323 @@
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from socket import socket, create_connection
+from typing import List, Optional
+
+import pytest
+
+import federation_protocol
+from chat_protocol import UserWroteMessage, UserStatusWasUpdated, UserStatus, SubmitMessage, MAX_USER_NAME_LENGTH, \
+  MAX_MESSAGE_LENGTH
+from client import Client
+from federation import SequenceTracker
+from federation_protocol import PeerHello, RelayedPacket, ClaimName, ClaimNameResponse
+from framed_protocol import Packet
+
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def round_trip(packet: Packet) -> Packet:
+  opaque_packet = Packet.extract_from(bytearray(bytes(packet)))
+  return federation_protocol.parse_packet(opaque_packet)
+
+
+def test_peer_hello_round_trip():
+  hello = round_trip(PeerHello("host:5100-0a1b2c3d", 2 ** 64 - 1))
+  assert (hello.node_id, hello.incarnation) == ("host:5100-0a1b2c3d", 2 ** 64 - 1)
+
+
+def test_relayed_packet_round_trip():
+  relayed = round_trip(RelayedPacket(2 ** 64 - 1, 1_700_000_000_000_000_000, UserWroteMessage("Ann", "hello")))
+  assert (relayed.origin, relayed.origin_seq) == (2 ** 64 - 1, 1_700_000_000_000_000_000)
+  assert isinstance(relayed.packet, UserWroteMessage)
+  assert (relayed.packet.user_name, relayed.packet.message) == ("Ann", "hello")
+
+  relayed = round_trip(RelayedPacket(1, 7, UserStatusWasUpdated("Ann", UserStatus.TYPING)))
+  assert (relayed.packet.user_name, relayed.packet.status) == ("Ann", UserStatus.TYPING)
+
+
+def test_relayed_packet_fits_largest_message():
+  packet = UserWroteMessage("n" * MAX_USER_NAME_LENGTH, "x" * MAX_MESSAGE_LENGTH)
+  relayed = round_trip(RelayedPacket(2 ** 64 - 1, 2 ** 64 - 1, packet))
+  assert (relayed.packet.user_name, relayed.packet.message) == (packet.user_name, packet.message)
+
+
+def test_relayed_packet_too_large():
+  with pytest.raises(Exception):
+    bytes(RelayedPacket(1, 1, UserWroteMessage("Ann", "x" * 240)))
+
+
+def test_claim_name_round_trip():
+  claim = round_trip(ClaimName(2 ** 64 - 1, 2 ** 32 - 1, "Ann"))
+  assert (claim.origin, claim.query_id, claim.user_name) == (2 ** 64 - 1, 2 ** 32 - 1, "Ann")
+  for granted in (True, False):
+    response = round_trip(ClaimNameResponse(7, 42, granted))
+    assert (response.origin, response.query_id, response.granted) == (7, 42, granted)
+
+
+def test_sequence_tracker_drops_duplicates():
+  tracker = SequenceTracker()
+  assert tracker.accept(1, 1)
+  assert not tracker.accept(1, 1)
+  assert tracker.accept(2, 1)  # Origins are tracked separately
+
+
+def test_sequence_tracker_accepts_out_of_order():
+  tracker = SequenceTracker()
+  assert tracker.accept(1, 5)
+  assert tracker.accept(1, 3)
+  assert tracker.accept(1, 4)
+  assert not tracker.accept(1, 3)
+
+
+def test_sequence_tracker_window():
+  tracker = SequenceTracker()
+  for seq in range(1, 3 * SequenceTracker.WINDOW):
+    assert tracker.accept(1, seq)
+  highest = 3 * SequenceTracker.WINDOW - 1
+  # Too old to tell whether it's a duplicate, so it's dropped
+  assert not tracker.accept(1, highest - SequenceTracker.WINDOW)
+  # Within the window, duplicates are still recognized after pruning
+  assert not tracker.accept(1, highest - SequenceTracker.WINDOW + 1)
+  assert not tracker.accept(1, highest)
+  assert tracker.accept(1, highest + 1)
+
+
+def test_sequence_tracker_origin_restart():
+  tracker = SequenceTracker()
+  for seq in range(1, 10):
+    assert tracker.accept(1, seq)
+  # A restarted node is a new origin, so it can start counting from 1 again
+  assert tracker.accept(2, 1)
+  assert tracker.accept(2, 2)
+
+
+# --- Smoke tests with several server processes ---
+
+def free_port() -> int:
+  with socket() as s:
+    s.bind(("localhost", 0))
+    return s.getsockname()[1]
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.05)
+  return True
+
+
+class Node:
+  def __init__(self, node_id: Optional[str] = None):
+    self.port = free_port()
+    self.peer_port = free_port()
+    self.node_id = node_id
+    self.process: Optional[subprocess.Popen] = None
+
+  def start(self, peers: List["Node"]):
+    args = [sys.executable, SERVER_SCRIPT, "--port", str(self.port), "--peer-port", str(self.peer_port)]
+    if self.node_id:
+      args += ["--node-id", self.node_id]
+    for peer in peers:
+      args += ["--peer", f"localhost:{peer.peer_port}"]
+    self.process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    assert wait_until(lambda: _can_connect(self.port))
+
+  def stop(self):
+    self.process.kill()
+    self.process.wait()
+
+
+def _can_connect(port: int) -> bool:
+  try:
+    create_connection(("localhost", port)).close()
+    return True
+  except OSError:
+    return False
+
+
+PROBE_PREFIX = "probe-"
+_probe_ids = itertools.count(1)
+
+
+class ChatUser:
+  def __init__(self, node: Node, user_name: Optional[str]):
+    self.received: List[Packet] = []
+    self._socket = create_connection(("localhost", node.port))
+    self.client = Client(self._socket, user_name, self.received.append)
+
+  def messages(self) -> List[str]:
+    return [p.message for p in self.received
+            if isinstance(p, UserWroteMessage) and not p.user_name.startswith(PROBE_PREFIX)]
+
+  def close(self):
+    self.client.close()
+
+
+def wait_for_links(nodes: List[Node]):
+  """ Waits until a message sent on any of the nodes reaches all the others. """
+  names = [f"{PROBE_PREFIX}{next(_probe_ids)}" for _ in nodes]
+  probes = [ChatUser(node, name) for node, name in zip(nodes, names)]
+  try:
+    for probe in probes:
+      probe.client.__enter__()
+
+    def all_probes_heard_each_other() -> bool:
+      for probe in probes:
+        probe.client.send_packets([SubmitMessage("probe")])
+      return all({p.user_name for p in probe.received if isinstance(p, UserWroteMessage)} >= set(names)
+                 for probe in probes)
+
+    assert wait_until(all_probes_heard_each_other, timeout=10)
+  finally:
+    for probe in probes:
+      probe.close()
+
+
+@pytest.fixture
+def nodes():
+  started = []
+
+  def start_nodes(*new_nodes: Node, peers_of=lambda i, started_so_far: started_so_far, linked=True):
+    for i, node in enumerate(new_nodes):
+      node.start(peers_of(i, list(new_nodes[:i])))
+      started.append(node)
+    if linked:
+      wait_for_links(started)
+    return new_nodes
+
+  yield start_nodes
+  for node in started:
+    node.stop()
+
+
+@pytest.fixture
+def users():
+  created = []
+
+  def log_in(node: Node, user_name: Optional[str]) -> ChatUser:
+    user = ChatUser(node, user_name)
+    created.append(user)
+    user.client.__enter__()
+    return user
+
+  yield log_in
+  for user in created:
+    user.close()
+
+
+def test_message_is_relayed_once_around_loop(nodes, users):
+  # Full mesh, which contains loops
+  a, b, c = nodes(Node(), Node(), Node())
+  ann, ben, cid = users(a, "Ann"), users(b, "Ben"), users(c, "Cid")
+  ann.client.send_packets([SubmitMessage("hello")])
+  assert wait_until(lambda: ben.messages() and cid.messages())
+  time.sleep(0.5)  # Any duplicates would have arrived by now
+  assert ben.messages() == ["hello"]
+  assert cid.messages() == ["hello"]
+  assert ann.messages() == ["hello"]
+
+
+def test_message_is_relayed_through_chain(nodes, users):
+  a, b, c = nodes(Node(), Node(), Node(), peers_of=lambda i, started_so_far: started_so_far[-1:])
+  ann, cid = users(a, "Ann"), users(c, "Cid")
+  ann.client.send_packets([SubmitMessage("hello")])
+  assert wait_until(lambda: cid.messages() == ["hello"])
+
+
+def test_name_taken_on_other_node(nodes, users):
+  a, b = nodes(Node(), Node())
+  users(a, "Ann")
+  with pytest.raises(Exception, match="Name taken"):
+    users(b, "Ann")
+
+
+def test_name_taken_on_node_behind_peer(nodes, users):
+  a, b, c = nodes(Node(), Node(), Node(), peers_of=lambda i, started_so_far: started_so_far[-1:])
+  users(a, "Ann")
+  with pytest.raises(Exception, match="Name taken"):
+    users(c, "Ann")
+  users(c, "Cid")
+
+
+def test_concurrent_claims_on_different_nodes(nodes, users):
+  a, b, c = nodes(Node(), Node(), Node(), peers_of=lambda i, started_so_far: started_so_far[-1:])
+  results = []
+
+  def try_log_in(node: Node):
+    try:
+      users(node, "Ann")
+      results.append(True)
+    except Exception:
+      results.append(False)
+
+  threads = [threading.Thread(target=try_log_in, args=(node,)) for node in (a, c)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert len(results) == 2
+  assert results.count(True) <= 1
+
+
+def test_users_on_lost_node_are_logged_out(nodes, users):
+  a, b, c = nodes(Node(), Node(), Node())
+  users(a, "Ann")
+  ben, cid = users(b, "Ben"), users(c, "Cid")
+  a.stop()
+  logged_out = UserStatusWasUpdated("Ann", UserStatus.LOGGED_OUT)
+  for user in (ben, cid):
+    assert wait_until(lambda: any(_same_status(p, logged_out) for p in user.received), timeout=10)
+  # Announced once per node, not once for every node that noticed
+  time.sleep(0.5)
+  assert sum(_same_status(p, logged_out) for p in ben.received) == 1
+
+
+def test_users_are_announced_to_nodes_that_join_later(nodes, users):
+  a, = nodes(Node())
+  users(a, "Ann")
+  b, = nodes(Node(), peers_of=lambda i, started_so_far: [a])
+  ben = users(b, "Ben")
+  # b can only log Ann out if a told it about her when they linked
+  a.stop()
+  logged_out = UserStatusWasUpdated("Ann", UserStatus.LOGGED_OUT)
+  assert wait_until(lambda: any(_same_status(p, logged_out) for p in ben.received), timeout=10)
+
+
+def _same_status(packet: Packet, expected: UserStatusWasUpdated) -> bool:
+  return isinstance(packet, UserStatusWasUpdated) \
+         and (packet.user_name, packet.status) == (expected.user_name, expected.status)
+
+
+def test_message_length_limit_is_the_same_on_all_nodes(nodes, users):
+  a, b = nodes(Node(), Node())
+  ann, ben = users(a, "Ann"), users(b, "Ben")
+  longest = "x" * MAX_MESSAGE_LENGTH
+  ann.client.send_packets([SubmitMessage(longest + "x")])
+  ann.client.send_packets([SubmitMessage(longest)])
+  ann.client.send_packets([SubmitMessage("short")])
+  assert wait_until(lambda: ann.messages() == [longest, "short"])
+  assert wait_until(lambda: ben.messages() == [longest, "short"])
+
+
+def test_name_too_long(nodes, users):
+  a, = nodes(Node())
+  with pytest.raises(Exception, match="Name too long"):
+    users(a, "n" * (MAX_USER_NAME_LENGTH + 1))
+
+
+def test_nodes_with_same_id_are_not_linked(nodes, users):
+  a, b = nodes(Node("same"), Node("same"), linked=False)
+  time.sleep(1.5)  # Time for b to try to link with a
+  ann, ben = users(a, "Ann"), users(b, "Ben")
+  ann.client.send_packets([SubmitMessage("hello")])
+  assert wait_until(lambda: ann.messages() == ["hello"])
+  time.sleep(0.5)
+  assert ben.messages() == []
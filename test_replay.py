@@ -0,0 +1,256 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from socket import socket, socketpair, create_connection
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+
+import chat_protocol
+from chat_protocol import Login, LoginResponse, SubmitMessage, SubmitUserStatus, UserStatus, UserStatusWasUpdated, \
+  UserWroteMessage
+from client import Client
+from framed_protocol import Packet, PacketSender, PacketReceiver
+from replay import build_schedule, parse_speed, replay, report, start_local_server
+from traffic_capture import TrafficRecorder, RecordKind, Record, read_recording
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def frame(packet: Packet) -> bytes:
+  return bytes(packet)
+
+
+# --- Capture file ---
+
+def record_sample(path: str) -> List[Record]:
+  recorder = TrafficRecorder(path)
+  first = recorder.new_connection()
+  first.inbound(frame(Login("Ann")))
+  first.outbound(frame(LoginResponse(True, "Ann")))
+  second = recorder.new_connection()
+  second.inbound(frame(SubmitMessage("")))
+  first.close()
+  recorder.close()
+  return [
+    Record(RecordKind.OPEN, 1, 0),
+    Record(RecordKind.INBOUND, 1, 0, frame(Login("Ann"))),
+    Record(RecordKind.OUTBOUND, 1, 0, frame(LoginResponse(True, "Ann"))),
+    Record(RecordKind.OPEN, 2, 0),
+    Record(RecordKind.INBOUND, 2, 0, frame(SubmitMessage(""))),
+    Record(RecordKind.CLOSE, 1, 0),
+  ]
+
+
+def without_timestamps(records: List[Record]) -> List[Record]:
+  return [Record(r.kind, r.connection_id, 0, r.frame) for r in records]
+
+
+def test_recording_round_trip(tmp_path):
+  path = str(tmp_path / "capture.bin")
+  expected = record_sample(path)
+  records = list(read_recording(path))
+  assert without_timestamps(records) == expected
+  timestamps = [r.timestamp_ns for r in records]
+  assert timestamps == sorted(timestamps)
+
+
+def test_recording_with_truncated_tail(tmp_path):
+  path = str(tmp_path / "capture.bin")
+  expected = record_sample(path)
+  with open(path, "rb") as f:
+    data = f.read()
+  # Cut off the last two records (CLOSE is 13 bytes, INBOUND SubmitMessage("") is 13 + 2) at every possible point
+  for cut in range(1, 13 + 15):
+    with open(path, "wb") as f:
+      f.write(data[:-cut])
+    records = without_timestamps(list(read_recording(path)))
+    assert records == expected[:len(records)]
+    assert len(records) == (5 if cut <= 13 else 4)
+
+
+def test_recording_with_bad_magic(tmp_path):
+  path = str(tmp_path / "capture.bin")
+  with open(path, "wb") as f:
+    f.write(b"not a capture")
+  with pytest.raises(Exception, match="Not a traffic capture file"):
+    list(read_recording(path))
+
+
+def test_recorder_ignores_writes_after_close(tmp_path):
+  path = str(tmp_path / "capture.bin")
+  recorder = TrafficRecorder(path)
+  connection = recorder.new_connection()
+  recorder.close()
+  connection.inbound(frame(Login("Ann")))
+  recorder.close()
+  assert without_timestamps(list(read_recording(path))) == [Record(RecordKind.OPEN, 1, 0)]
+
+
+def test_capture_hooks():
+  a, b = socketpair()
+  with a, b:
+    sent, received = [], []
+    sender = PacketSender(a, sent.append)
+    receiver = PacketReceiver(b, chat_protocol.parse_packet, received.append)
+    sender.send_packet(Login("Ann"))
+    sender.send_packets([SubmitMessage("hello"), SubmitUserStatus(UserStatus.TYPING)])
+    sender.send_frame(frame(SubmitMessage("again")))
+    for _ in range(4):
+      receiver.wait_for_packet()
+  expected = [frame(Login("Ann")), frame(SubmitMessage("hello")), frame(SubmitUserStatus(UserStatus.TYPING)),
+              frame(SubmitMessage("again"))]
+  assert sent == expected
+  assert received == expected
+
+
+def test_opaque_packet_bytes():
+  original = frame(UserWroteMessage("Ann", "hello"))
+  assert bytes(Packet.extract_from(bytearray(original))) == original
+
+
+# --- Schedule and report ---
+
+def sample_schedule_records() -> List[Record]:
+  return [
+    Record(RecordKind.OPEN, 1, 0),
+    Record(RecordKind.INBOUND, 1, 1, frame(Login("Ann"))),
+    Record(RecordKind.OUTBOUND, 1, 2, frame(LoginResponse(True, "Ann"))),
+    Record(RecordKind.OPEN, 2, 3),
+    Record(RecordKind.INBOUND, 2, 4, frame(Login("Ben"))),
+    Record(RecordKind.OUTBOUND, 2, 5, frame(LoginResponse(True, "Ben"))),
+    Record(RecordKind.INBOUND, 2, 6, frame(SubmitUserStatus(UserStatus.TYPING))),
+    Record(RecordKind.OUTBOUND, 1, 7, frame(UserStatusWasUpdated("Ben", UserStatus.TYPING))),
+    Record(RecordKind.INBOUND, 1, 8, frame(SubmitMessage("hi"))),
+    Record(RecordKind.OUTBOUND, 2, 9, frame(UserWroteMessage("Ann", "hi"))),
+    Record(RecordKind.OUTBOUND, 1, 10, frame(UserWroteMessage("Ann", "hi"))),
+    Record(RecordKind.INBOUND, 1, 11, frame(Login("Ann"))),
+    Record(RecordKind.OUTBOUND, 1, 12, frame(LoginResponse(False, "Name taken."))),
+    Record(RecordKind.CLOSE, 2, 13),
+  ]
+
+
+def test_build_schedule():
+  schedule = build_schedule(sample_schedule_records())
+  responses = [step.response_index for step in schedule.steps if step.record.kind == RecordKind.INBOUND]
+  # The status update only leads to frames on other connections. The message's own echo counts as its response, even
+  # though it was sent to the other connection first.
+  assert responses == [0, 0, None, 2, 3]
+  assert {c: len(frames) for c, frames in schedule.expected_outbound.items()} == {1: 4, 2: 2}
+  assert schedule.closed_user_names == {"Ben"}
+
+
+def replayed_schedule():
+  schedule = build_schedule(sample_schedule_records())
+  for step in schedule.steps:
+    step.sent_at = 0.0
+  return schedule
+
+
+def fake_connections(received_by_connection):
+  return {c: SimpleNamespace(received_frames=frames, arrival_times=[0.0] * len(frames))
+          for c, frames in received_by_connection.items()}
+
+
+@pytest.mark.parametrize("extra, ok", [
+  ([], True),
+  ([frame(UserStatusWasUpdated("Ben", UserStatus.LOGGED_OUT))], True),  # Ben's connection was closed
+  ([frame(UserStatusWasUpdated("Cid", UserStatus.LOGGED_OUT))], False),
+  ([frame(UserStatusWasUpdated("Ben", UserStatus.TYPING))], False),
+  ([frame(UserWroteMessage("Ben", "bye"))], False),
+])
+def test_report_extra_frames(extra, ok, capsys):
+  schedule = replayed_schedule()
+  received = {c: list(frames) for c, frames in schedule.expected_outbound.items()}
+  received[1] += extra
+  assert report(schedule, fake_connections(received), 1.0) == ok
+  output = capsys.readouterr().out
+  assert ("LATE" in output) == (bool(extra) and ok)
+  assert ("MISMATCH" in output) == (not ok)
+
+
+def test_report_missing_frame():
+  schedule = replayed_schedule()
+  received = {c: list(frames) for c, frames in schedule.expected_outbound.items()}
+  received[1].pop()
+  assert not report(schedule, fake_connections(received), 1.0)
+
+
+def test_parse_speed():
+  assert parse_speed("max") is None
+  assert parse_speed("1") == 1.0
+  assert parse_speed("10x") == 10.0
+  assert parse_speed("0.5x") == 0.5
+  for invalid in ("0", "0x", "-1", "fast", "x"):
+    with pytest.raises(argparse.ArgumentTypeError):
+      parse_speed(invalid)
+
+
+# --- Recording a real server and replaying it ---
+
+def free_port() -> int:
+  with socket() as s:
+    s.bind(("localhost", 0))
+    return s.getsockname()[1]
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.05)
+  return True
+
+
+def record_session(path: str):
+  port = free_port()
+  process = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--port", str(port), "--capture", path],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    assert wait_until(lambda: _can_connect(port))
+    received = []
+    with Client(create_connection(("localhost", port)), "Ann", lambda packet: None) as ann:
+      with Client(create_connection(("localhost", port)), "Ben", received.append) as ben:
+        ann.send_packets([SubmitUserStatus(UserStatus.TYPING)])
+        ann.send_packets([SubmitMessage("hello")])
+        assert wait_until(lambda: any(isinstance(p, UserWroteMessage) for p in received))
+        ben.send_packets([SubmitMessage("hi Ann")])
+        time.sleep(0.2)
+      time.sleep(0.2)
+  finally:
+    # Lets the server close the capture file properly
+    process.send_signal(signal.SIGINT)
+    process.wait(5)
+
+
+def _can_connect(port: int) -> bool:
+  try:
+    create_connection(("localhost", port)).close()
+    return True
+  except OSError:
+    return False
+
+
+@pytest.mark.parametrize("speed", [None, 2.0])
+def test_record_and_replay(tmp_path, speed, capsys):
+  path = str(tmp_path / "capture.bin")
+  record_session(path)
+  schedule = build_schedule(list(read_recording(path)))
+  assert any(step.record.kind == RecordKind.CLOSE for step in schedule.steps)
+
+  port = free_port()
+  server_process = start_local_server(port)
+  try:
+    connections, duration = replay(schedule, port, speed)
+    all_matched = report(schedule, connections, duration)
+  finally:
+    server_process.kill()
+    server_process.wait()
+  output = capsys.readouterr().out
+  assert all_matched, output
+  assert "LOGIN" in output and "SUBMIT_MESSAGE" in output
@@ -0,0 +1,123 @@
+import itertools
+import queue
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Iterator, BinaryIO, Optional
+
+MAGIC = b"PYCHATCAP1\n"
+
+# Every record is [ KIND | CONNECTION ID | TIMESTAMP (ns since start of capture) ] followed, for frame records, by the
+# frame itself. Frames start with their own payload length, so no extra length field is needed.
+_RECORD_HEADER = struct.Struct("!BIQ")
+
+
+class RecordKind(Enum):
+  OPEN = 1
+  CLOSE = 2
+  INBOUND = 3  # Frame received by the server
+  OUTBOUND = 4  # Frame sent by the server
+
+
+@dataclass
+class Record:
+  kind: RecordKind
+  connection_id: int
+  timestamp_ns: int
+  frame: bytes = b""
+
+
+class ConnectionCapture:
+  """ Records the traffic of a single connection. The methods fit the capture hooks of PacketSender/PacketReceiver. """
+
+  def __init__(self, recorder: "TrafficRecorder", connection_id: int):
+    self._recorder = recorder
+    self.connection_id = connection_id
+
+  def inbound(self, frame: bytes):
+    self._recorder.write(RecordKind.INBOUND, self.connection_id, frame)
+
+  def outbound(self, frame: bytes):
+    self._recorder.write(RecordKind.OUTBOUND, self.connection_id, frame)
+
+  def close(self):
+    self._recorder.write(RecordKind.CLOSE, self.connection_id)
+
+
+class TrafficRecorder:
+  """
+  Writes timestamped frames from all connections of a server to a single capture file. Records are handed over to a
+  writer thread through a queue, so that client threads (which record while holding their sender's lock) never wait for
+  the file.
+  """
+  _STOP = None
+
+  def __init__(self, path: str):
+    self._file = open(path, "wb")
+    self._file.write(MAGIC)
+    self._start_ns = time.monotonic_ns()
+    self._connection_ids = itertools.count(1)
+    self._queue: "queue.SimpleQueue[Optional[bytes]]" = queue.SimpleQueue()
+    self._closed = False
+    self._writer_thread = threading.Thread(target=self._write_records, daemon=True)
+    self._writer_thread.start()
+
+  def new_connection(self) -> ConnectionCapture:
+    connection_id = next(self._connection_ids)
+    self.write(RecordKind.OPEN, connection_id)
+    return ConnectionCapture(self, connection_id)
+
+  def write(self, kind: RecordKind, connection_id: int, frame: bytes = b""):
+    if self._closed:
+      return  # Client threads may outlive the recorder when the server is shutting down
+    timestamp_ns = time.monotonic_ns() - self._start_ns
+    self._queue.put(_RECORD_HEADER.pack(kind.value, connection_id, timestamp_ns) + frame)
+
+  def close(self):
+    """ Writes all records that are already queued, and closes the file. """
+    if not self._closed:
+      self._closed = True
+      self._queue.put(TrafficRecorder._STOP)
+      self._writer_thread.join()
+
+  def _write_records(self):
+    with self._file:
+      while True:
+        record = self._queue.get()
+        if record is TrafficRecorder._STOP:
+          return
+        self._file.write(record)
+        if self._queue.empty():
+          # Caught up, so this is cheap. Keeps the file useful even if the server gets killed.
+          self._file.flush()
+
+
+def read_recording(path: str) -> Iterator[Record]:
+  with open(path, "rb") as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise Exception(f"Not a traffic capture file: {path}")
+    while True:
+      record = _read_record(f)
+      if not record:
+        return
+      yield record
+
+
+def _read_record(f: BinaryIO):
+  header = f.read(_RECORD_HEADER.size)
+  if len(header) < _RECORD_HEADER.size:
+    return None  # End of file, or a record cut off by the server being killed
+  kind_value, connection_id, timestamp_ns = _RECORD_HEADER.unpack(header)
+  kind = RecordKind(kind_value)
+  frame = b""
+  if kind in (RecordKind.INBOUND, RecordKind.OUTBOUND):
+    frame_header = f.read(2)
+    if len(frame_header) < 2:
+      return None
+    payload = f.read(frame_header[0])
+    if len(payload) < frame_header[0]:
+      return None
+    frame = frame_header + payload
+  return Record(kind, connection_id, timestamp_ns, frame)